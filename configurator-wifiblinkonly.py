@@ -3,24 +3,67 @@
 import os
 import sys
 import subprocess
+import json
+import ctypes
+import errno
 import re
 import getpass
 
+# Printable ASCII, 1-32 characters, as allowed for a WiFi SSID
+SSID_PATTERN = re.compile(r'^[\x20-\x7E]{1,32}$')
+
+# Run lsblk/mount/umount untranslated so they skip loading message catalogs
+C_LOCALE_ENV = dict(os.environ, LC_ALL='C')
+
+# eMMC hardware partitions (mmcblkNboot0/1, mmcblkNrpmb), never an SD card
+MMC_HW_PARTITION = re.compile(r'(boot\d+|rpmb)$')
+
+# libc's mount(2)/umount2(2), used to avoid forking mount(8)/umount(8); the
+# interpreter already has libc loaded, so CDLL(None) needs no library lookup
+LIBC = ctypes.CDLL(None, use_errno=True)
+LIBC.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_void_p]
+LIBC.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+
 # Check for root privileges
 if os.geteuid() != 0:
     print("This script must be run as root. Please run with sudo.")
     sys.exit(1)
 
+# Piped answers (e.g. an expect script or answers file) are read straight off
+# stdin rather than through input()'s line editing and getpass's /dev/tty
+INTERACTIVE = sys.stdin.isatty()
+
+def read_line(prompt):
+    if INTERACTIVE:
+        return input(prompt)
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        raise EOFError
+    return line.rstrip('\n')
+
+def read_password(prompt):
+    if INTERACTIVE:
+        return getpass.getpass(prompt)
+    return read_line(prompt)
+
+def is_back(value):
+    # Length check first so ordinary answers skip the lower() copy
+    return len(value) == 4 and value.lower() == 'back'
+
 def prompt_input(prompt, pattern=None, allow_empty=False):
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern)
     while True:
         try:
-            value = input(prompt).strip()
-            if value.lower() == 'back':
+            value = read_line(prompt).strip()
+            if is_back(value):
                 return 'back'
             if not value and not allow_empty:
                 print("Input cannot be empty.")
                 continue
-            if pattern and not re.match(pattern, value):
+            if pattern and not pattern.match(value):
                 print("Input contains invalid characters or does not meet the criteria.")
                 continue
             return value
@@ -30,65 +73,165 @@ def prompt_input(prompt, pattern=None, allow_empty=False):
 
 def confirm_password(prompt="Enter password: ", min_length=1, max_length=63):
     while True:
-        pwd1 = getpass.getpass(prompt)
-        if pwd1.lower() == 'back':
+        pwd1 = read_password(prompt)
+        if is_back(pwd1):
             return 'back'
         if len(pwd1) < min_length or len(pwd1) > max_length:
             print(f"Password must be between {min_length} and {max_length} characters.")
             continue
-        pwd2 = getpass.getpass("Confirm password: ")
-        if pwd2.lower() == 'back':
+        pwd2 = read_password("Confirm password: ")
+        if is_back(pwd2):
             return 'back'
         if pwd1 != pwd2:
             print("Passwords do not match. Please try again.")
         else:
             return pwd1
 
+_block_devices_cache = None
+
+def read_sysfs(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def format_size(num_bytes):
+    # Human-readable size in the style of lsblk (e.g. 29.7G)
+    size = float(num_bytes)
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024
+    return f"{size:.1f}".rstrip('0').rstrip('.') + unit
+
+def read_sys_block():
+    # Build the same device tree lsblk -J reports, straight from sysfs
+    devices = []
+    for name in sorted(os.listdir('/sys/block')):
+        dev_dir = f"/sys/block/{name}"
+        if '/usb' in os.path.realpath(dev_dir):
+            tran = 'usb'
+        elif name.startswith('mmcblk'):
+            tran = 'mmc'
+        else:
+            tran = None
+        model = read_sysfs(f"{dev_dir}/device/model") or read_sysfs(f"{dev_dir}/device/name")
+        size = format_size(int(read_sysfs(f"{dev_dir}/size")) * 512)
+        parts = [entry for entry in os.listdir(dev_dir) if os.path.exists(f"{dev_dir}/{entry}/partition")]
+        parts.sort(key=lambda entry: int(read_sysfs(f"{dev_dir}/{entry}/partition")))
+        children = [{'name': part, 'type': 'part'} for part in parts]
+        devices.append({'name': name, 'model': model, 'tran': tran, 'size': size, 'type': 'disk', 'children': children})
+    return devices
+
+def read_lsblk():
+    # json.loads takes the raw bytes, so skip the text-mode decode
+    lsblk_output = subprocess.run(['lsblk', '-J', '-o', 'NAME,MODEL,TRAN,SIZE,TYPE'], stdout=subprocess.PIPE, env=C_LOCALE_ENV, check=True).stdout
+    return json.loads(lsblk_output)['blockdevices']
+
+def list_block_devices():
+    # Scan sysfs once and reuse the device tree for the rest of the run;
+    # lsblk is only forked if /sys/block is missing or laid out unexpectedly
+    global _block_devices_cache
+    if _block_devices_cache is None:
+        try:
+            _block_devices_cache = read_sys_block()
+        except (OSError, TypeError, ValueError):
+            _block_devices_cache = read_lsblk()
+    return _block_devices_cache
+
 def detect_sd_card():
     print("Detecting SD card devices...")
     devices = []
-    # Use lsblk to list all block devices
-    lsblk_output = subprocess.check_output(['lsblk', '-S', '-o', 'NAME,MODEL,TRAN,SIZE'], universal_newlines=True)
-    lines = lsblk_output.strip().split('\n')
-    device_lines = lines[1:]
-    for line in device_lines:
-        parts = re.split(r'\s+', line.strip())
-        if len(parts) < 4:
+    mounted = mounted_devices()
+    for dev in list_block_devices():
+        # Skip eMMC hardware partitions and any disk the host has mounted, e.g. its own boot card
+        if MMC_HW_PARTITION.search(dev['name']) or disk_in_use(dev, mounted):
             continue
-        name, model, tran, size = parts
-        device_path = f"/dev/{name}"
+        device_path = f"/dev/{dev['name']}"
+        model = (dev.get('model') or '').strip()
+        tran = dev.get('tran') or ''
         # Assume that devices with 'usb' or 'mmc' transport are removable drives
         if tran.lower() in ['usb', 'mmc']:
-            devices.append((device_path, model, size))
+            devices.append((device_path, model, dev['size']))
     if not devices:
         print("No removable devices detected. Please insert the SD card and try again.")
         sys.exit(1)
     print("Available devices:")
-    for idx, dev in enumerate(devices, 1):
-        device_path, model, size = dev
-        print(f"{idx}. {device_path} - {model} - {size}")
+    # One write for the whole list; slow serial consoles pay per write
+    print('\n'.join(f"{idx}. {device_path} - {model} - {size}" for idx, (device_path, model, size) in enumerate(devices, 1)))
     while True:
-        choice = input("Select the SD card device to configure: ")
+        choice = read_line("Select the SD card device to configure: ")
         if choice.isdigit() and 1 <= int(choice) <= len(devices):
             return devices[int(choice)-1][0]
         else:
             print(f"Please enter a number between 1 and {len(devices)}.")
 
+def read_mountinfo():
+    # /proc/self/mountinfo lists every active mount without forking mount(8)
+    with open('/proc/self/mountinfo') as f:
+        return f.read()
+
+def is_mounted(mount_point):
+    return f' {mount_point} ' in read_mountinfo()
+
+def mounted_devices():
+    # major:minor and source of every mount; the root often shows up as /dev/root,
+    # so the major:minor is what identifies it
+    devices = set()
+    for line in read_mountinfo().splitlines():
+        fields = line.split()
+        devices.add(fields[2])
+        devices.add(fields[fields.index('-') + 2])
+    return devices
+
+def disk_in_use(dev, mounted):
+    for name in [dev['name']] + [child['name'] for child in dev.get('children', [])]:
+        if f"/dev/{name}" in mounted or read_sysfs(f"/sys/class/block/{name}/dev") in mounted:
+            return True
+    return False
+
+def libc_error(path):
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err), path)
+
+def mount_device(partition, mount_point):
+    # Armbian's root is ext4, so try mount(2) directly; only a partition that is
+    # not ext4 (EINVAL/ENODEV) is left to mount(8) to probe for its type
+    if LIBC.mount(partition.encode(), mount_point.encode(), b'ext4', 0, None) != 0:
+        if ctypes.get_errno() not in (errno.EINVAL, errno.ENODEV):
+            raise libc_error(partition)
+        subprocess.run(['mount', partition, mount_point], env=C_LOCALE_ENV, check=True)
+
+def umount_device(mount_point):
+    if LIBC.umount2(mount_point.encode(), 0) != 0:
+        raise libc_error(mount_point)
+
 def mount_partitions(device):
     # Attempt to find the root partition (ext4)
     mount_point = '/mnt/orangepi_root'
     if not os.path.exists(mount_point):
         os.makedirs(mount_point)
-    partitions = [device + suffix for suffix in ['p1', '1']]
+    if is_mounted(mount_point):
+        print(f"{mount_point} is already mounted. Please unmount it and try again.")
+        sys.exit(1)
+    # Walk the partitions already listed for the selected device
+    name = os.path.basename(device)
+    partitions = []
+    for dev in list_block_devices():
+        if dev['name'] == name:
+            partitions = [f"/dev/{child['name']}" for child in dev.get('children', []) if child['type'] == 'part']
+            break
     partition_found = False
     for partition in partitions:
         if os.path.exists(partition):
             try:
                 print(f"Trying to mount {partition} to {mount_point}...")
-                subprocess.run(['mount', partition, mount_point], check=True)
+                mount_device(partition, mount_point)
                 partition_found = True
                 break
-            except subprocess.CalledProcessError:
+            except (subprocess.CalledProcessError, OSError) as e:
+                print(f"Could not mount {partition}: {e}")
                 continue
     if not partition_found:
         print("Could not find a valid partition to mount.")
@@ -96,69 +239,66 @@ def mount_partitions(device):
     return mount_point
 
 def unmount_partitions(mount_point):
+    if not is_mounted(mount_point):
+        return
     print(f"Unmounting {mount_point}...")
-    subprocess.run(['umount', mount_point], check=True)
-
-def main():
-    print("Welcome to the Orange Pi Zero 2W Configurator")
-
-    # Step 1: Detect and Mount SD Card
-    device = detect_sd_card()
-    mount_point = mount_partitions(device)
-
+    umount_device(mount_point)
+
+def write_file(path, data, mode=0o644, uid=0, gid=0):
+    # Write into a temp file beside path with its final mode and owner set on the fd,
+    # then swap it in with os.replace so the target is never left half-written
+    if isinstance(data, str):
+        data = data.encode()
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
     try:
-        # Step 2: Collect User Inputs
-        inputs = {}
-        step = 0
-        steps = ['Configure WiFi']
-
-        while step < len(steps):
-            print(f"\n--- {steps[step]} ---")
-            print("Type 'back' to return to the previous step.")
-
-            if step == 0:
-                ssid = prompt_input("Enter WiFi SSID: ", pattern=r'^[\x20-\x7E]{1,32}$')
-                if ssid == 'back':
-                    print("Cannot go back from the first step.")
-                    continue
-                wifi_pwd = confirm_password("Enter WiFi password: ", min_length=8, max_length=63)
-                if wifi_pwd == 'back':
-                    continue  # Stay on the same step to re-enter SSID
-                inputs['ssid'] = ssid
-                inputs['wifi_pwd'] = wifi_pwd
-                step += 1
-
-            else:
-                step += 1
-
-        # Step 3: Modify Configuration Files Directly
-
-        # 3.1 Configure WiFi
-        netplan_dir = os.path.join(mount_point, 'etc/netplan')
-        os.makedirs(netplan_dir, exist_ok=True)
-        netplan_conf = os.path.join(netplan_dir, '30-wifis-dhcp.yaml')
-        with open(netplan_conf, 'w') as f:
-            f.write(f"""network:
+        os.fchmod(fd, mode)
+        os.fchown(fd, uid, gid)
+        while data:
+            data = data[os.write(fd, data):]
+    except BaseException:
+        # Don't leave a partial temp file behind on the card
+        os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    os.close(fd)
+    os.replace(tmp_path, path)
+
+# Written to /etc/netplan/30-wifis-dhcp.yaml; filled with the quoted SSID and password
+NETPLAN_TEMPLATE = b"""network:
   version: 2
   renderer: networkd
   wifis:
     wlan0:
       dhcp4: true
       access-points:
-        "{inputs['ssid']}":
-          password: "{inputs['wifi_pwd']}"
-""")
+        %b:
+          password: %b
+"""
 
-        # 3.2 Install blink_ip.sh script
-        blink_script = os.path.join(mount_point, 'usr/local/bin/blink_ip.sh')
-        os.makedirs(os.path.dirname(blink_script), exist_ok=True)
-        with open(blink_script, 'w') as f:
-            f.write("""#!/bin/bash
+# Characters json.dumps leaves raw that YAML rejects or reads as line breaks:
+# DEL, the C1 controls (NEL included), U+2028/U+2029, the BOM and U+FFFE/U+FFFF
+YAML_UNSAFE_ESCAPES = {c: f'\\u{c:04x}' for c in [0x7F, *range(0x80, 0xA0), 0x2028, 0x2029, 0xFEFF, 0xFFFE, 0xFFFF]}
+
+def yaml_quote(value):
+    # json.dumps escapes quotes, backslashes and C0 controls; the table covers the rest
+    return json.dumps(value, ensure_ascii=False).translate(YAML_UNSAFE_ESCAPES).encode()
+
+# Installed as /usr/local/bin/blink_ip.sh on the SD card
+BLINK_IP_SCRIPT = b"""#!/bin/bash
 
 # Disable the default trigger for the green LED
 original_trigger=$(cat /sys/class/leds/green_led/trigger)
 echo none > /sys/class/leds/green_led/trigger
 
+# Hold a pipe that is never written so pause can time out on the read builtin
+exec 3<> <(:)
+
+# Function to wait without forking a sleep process
+pause() {
+  read -t "$1" -u 3 || :
+}
+
 # Function to turn the LED on
 led_on() {
   echo 1 > /sys/class/leds/green_led/brightness
@@ -172,64 +312,42 @@ led_off() {
 # Functions to represent blink durations
 blink_short() {  # Represents 'I' (1)
   led_on
-  sleep 0.1
+  pause 0.1
   led_off
-  sleep 0.1
+  pause 0.1
 }
 
 blink_medium() {  # Represents 'V' (5)
   led_on
-  sleep 0.4
+  pause 0.4
   led_off
-  sleep 0.1
+  pause 0.1
 }
 
 blink_long() {  # Represents 'X' (10) or 0
   led_on
-  sleep 1.2
+  pause 1.2
   led_off
-  sleep 0.1
+  pause 0.1
 }
 
 blink_subtractive() {  # Represents subtractive notation ('IV' for 4, 'IX' for 9)
   led_on
-  sleep 0.1
+  pause 0.1
   led_off
-  sleep 0.1
+  pause 0.1
   led_on
-  sleep 0.4
+  pause 0.4
   led_off
-  sleep 0.1
+  pause 0.1
 }
 
-# Function to convert a digit to Roman numerals
-digit_to_roman() {
-  local n=$1
-  local result=""
-
-  if [ $n -eq 0 ]; then
-    result="X"
-  elif [ $n -eq 4 ]; then
-    result="IV"
-  elif [ $n -eq 9 ]; then
-    result="IX"
-  else
-    if [ $n -ge 5 ]; then
-      result="V"
-      n=$(( n - 5 ))
-    fi
-    if [ $n -ge 1 ]; then
-      result="${result}$(printf 'I%.0s' $(seq 1 $n))"
-    fi
-  fi
-
-  echo "$result"
-}
+# Roman numeral code for each decimal digit, indexed by the digit (0 is a long X)
+ROMAN=(X I II III IV V VI VII VIII IX)
 
 # Function to blink a digit
 blink_digit() {
-  local digit=$1
-  local roman=$(digit_to_roman $digit)
+  local roman=${ROMAN[$1]}
 
   for (( i=0; i<${#roman}; i++ )); do
     c=${roman:$i:1}
@@ -245,28 +363,13 @@ blink_digit() {
   done
 
   # Wait 1 second between digits
-  sleep 1
+  pause 1
 }
 
 # Function to blink the IP address
 blink_ip() {
-  for octet in "${digits[@]}"; do
-    # Break down the octet into individual digits
-    if [ $octet -ge 100 ]; then
-      digit1=$(( octet / 100 ))
-      digit2=$(( (octet % 100) / 10 ))
-      digit3=$(( octet % 10 ))
-      blink_digit $digit1
-      blink_digit $digit2
-      blink_digit $digit3
-    elif [ $octet -ge 10 ]; then
-      digit1=$(( octet / 10 ))
-      digit2=$(( octet % 10 ))
-      blink_digit $digit1
-      blink_digit $digit2
-    else
-      blink_digit $octet
-    fi
+  for digit in "${ip_digits[@]}"; do
+    blink_digit $digit
   done
 }
 
@@ -294,22 +397,27 @@ else
   fi
 fi
 
+# Break the octets down into individual digits once, before the blink loop
+ip_digits=()
+for octet in "${digits[@]}"; do
+  for (( i=0; i<${#octet}; i++ )); do
+    ip_digits+=(${octet:$i:1})
+  done
+done
+
 # Blink the IP address ten times
 for (( count=0; count<10; count++ )); do
   blink_ip
   # Wait 2 seconds between each complete IP blink sequence
-  sleep 2
+  pause 2
 done
 
 # Restore the original trigger for the green LED
 echo "$original_trigger" > /sys/class/leds/green_led/trigger
-""")
-        os.chmod(blink_script, 0o755)
+"""
 
-        # 3.3 Create systemd service
-        service_file = os.path.join(mount_point, 'etc/systemd/system/blinkip.service')
-        with open(service_file, 'w') as f:
-            f.write("""[Unit]
+# Installed as /etc/systemd/system/blinkip.service on the SD card
+BLINK_IP_SERVICE = b"""[Unit]
 Description=Blink IP address on green LED
 After=network-online.target
 Wants=network-online.target
@@ -321,16 +429,76 @@ RemainAfterExit=no
 
 [Install]
 WantedBy=multi-user.target
-""")
+"""
+
+def main():
+    print("Welcome to the Orange Pi Zero 2W Configurator")
+
+    # Step 1: Detect and Mount SD Card
+    device = detect_sd_card()
+    mount_point = mount_partitions(device)
+    etc_dir = f"{mount_point}/etc"
+    systemd_dir = f"{etc_dir}/systemd/system"
+
+    try:
+        # Step 2: Collect User Inputs
+        inputs = {}
+        step = 0
+        steps = ['Configure WiFi']
+
+        while step < len(steps):
+            print(f"\n--- {steps[step]} ---")
+            print("Type 'back' to return to the previous step.")
+
+            if step == 0:
+                ssid = prompt_input("Enter WiFi SSID: ", pattern=SSID_PATTERN)
+                if ssid == 'back':
+                    print("Cannot go back from the first step.")
+                    continue
+                wifi_pwd = confirm_password("Enter WiFi password: ", min_length=8, max_length=63)
+                if wifi_pwd == 'back':
+                    continue  # Stay on the same step to re-enter SSID
+                inputs['ssid'] = ssid
+                inputs['wifi_pwd'] = wifi_pwd
+                step += 1
+
+            else:
+                step += 1
+
+        # Step 3: Modify Configuration Files Directly
+
+        # Create every directory the generated files need in one pass
+        netplan_dir = f"{etc_dir}/netplan"
+        bin_dir = f"{mount_point}/usr/local/bin"
+        wants_dir = f"{systemd_dir}/multi-user.target.wants"
+        for directory in (netplan_dir, bin_dir, wants_dir):
+            os.makedirs(directory, exist_ok=True)
+
+        # 3.1 Configure WiFi
+        netplan_conf = f"{netplan_dir}/30-wifis-dhcp.yaml"
+        netplan_yaml = NETPLAN_TEMPLATE % (yaml_quote(inputs['ssid']), yaml_quote(inputs['wifi_pwd']))
+        write_file(netplan_conf, netplan_yaml, 0o600)
+
+        # 3.2 Install blink_ip.sh script
+        blink_script = f"{bin_dir}/blink_ip.sh"
+        write_file(blink_script, BLINK_IP_SCRIPT, 0o755)
+
+        # 3.3 Create systemd service
+        service_file = f"{systemd_dir}/blinkip.service"
+        write_file(service_file, BLINK_IP_SERVICE)
         # Enable the service by creating a symlink
-        wants_dir = os.path.join(mount_point, 'etc/systemd/system/multi-user.target.wants')
-        os.makedirs(wants_dir, exist_ok=True)
-        service_symlink = os.path.join(wants_dir, 'blinkip.service')
-        if not os.path.exists(service_symlink):
-            os.symlink('/etc/systemd/system/blinkip.service', service_symlink)
+        service_symlink = f"{wants_dir}/blinkip.service"
+        service_target = '/etc/systemd/system/blinkip.service'
+        try:
+            os.symlink(service_target, service_symlink)
+        except FileExistsError:
+            # Replace whatever is there unless it is already our link
+            if not os.path.islink(service_symlink) or os.readlink(service_symlink) != service_target:
+                os.remove(service_symlink)
+                os.symlink(service_target, service_symlink)
 
     finally:
-        # Cleanup
+        # Cleanup; umount2 writes back the card's dirty pages itself
         unmount_partitions(mount_point)
 
     print("Configuration complete. You can now insert the SD card into your Orange Pi Zero 2W and boot it.")